@@ -1,19 +1,62 @@
 import os
+import sys
 import asyncio
-import json
+import time
+import heapq
+import operator
+import re
+import mimetypes
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import quote
 
-from fastapi import FastAPI, Request, Form, BackgroundTasks, Query
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, Request, Form, Query, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import aiofiles
+import aiofiles.os
 from pydantic import BaseModel
+from cachetools import TTLCache
+import orjson
 import yt_dlp
 
-app = FastAPI(title="YouTube Downloader")
+# 使用orjson序列化JSON响应，比标准库json快
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+# 启动时开启后台任务，退出时停止并写入尚未保存的视频信息
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global MAIN_LOOP, YTDLP_POOL, INFO_POOL, _DL_SEM, _videos_lock, _videos_dirty
+    MAIN_LOOP = asyncio.get_running_loop()
+    # 线程池和asyncio同步原语每次启动时重新创建，绑定到当前事件循环
+    YTDLP_POOL = ThreadPoolExecutor(max_workers=MAX_DOWNLOADS, thread_name_prefix='yt-dlp')
+    INFO_POOL = ThreadPoolExecutor(max_workers=INFO_WORKERS, thread_name_prefix='yt-dlp-info')
+    _DL_SEM = asyncio.Semaphore(MAX_DOWNLOADS)
+    _videos_lock = asyncio.Lock()
+    _videos_dirty = asyncio.Event()
+    if _pending_lines:
+        _videos_dirty.set()
+    compact_task = asyncio.create_task(_compact_videos_log_periodically())
+    flush_task = asyncio.create_task(_flush_videos_log_periodically())
+    
+    yield
+    
+    compact_task.cancel()
+    flush_task.cancel()
+    YTDLP_POOL.shutdown(wait=False, cancel_futures=True)
+    INFO_POOL.shutdown(wait=False, cancel_futures=True)
+    await _flush_videos_log()
+    MAIN_LOOP = None
+
+app = FastAPI(title="YouTube Downloader", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # 创建下载目录
 BASE_DIR = Path(__file__).resolve().parent
@@ -29,16 +72,74 @@ STATIC_DIR.mkdir(exist_ok=True)
 
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
-app.mount("/downloads", StaticFiles(directory=str(DOWNLOAD_DIR)), name="downloads")
+
+# 部署在Nginx后面时，设置为Nginx中internal location的路径（如 /internal-downloads/），
+# 由Nginx直接发送下载的文件
+DOWNLOADS_ACCEL_PREFIX = os.environ.get('DOWNLOADS_ACCEL_PREFIX')
 
 # 设置模板
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
-# 存储下载进度的全局变量
-download_progress = {}
+# 存储下载进度的全局变量（按最近更新排序，超出上限时淘汰最早的记录）
+download_progress: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+MAX_PROGRESS_ENTRIES = 1024
+# 进度在yt-dlp线程和事件循环中都会修改
+_progress_lock = threading.Lock()
+
+# 下载中的进度最短更新间隔（秒），yt-dlp每收到一个数据块就会调用一次进度钩子
+PROGRESS_INTERVAL = 0.1
+# 每个视频上次更新进度的时间
+_LAST_EMIT: Dict[str, float] = {}
+
+# 同时进行的下载数上限（包括流式下载），超出的下载保持queued状态排队等待
+# 线程池、信号量等在lifespan中创建
+MAX_DOWNLOADS = int(os.environ.get('MAX_DOWNLOADS', '4'))
+_DL_SEM: Optional[asyncio.Semaphore] = None
+
+# 正在进行的下载任务（按视频ID），同一视频同时只下载一次
+ACTIVE_DOWNLOADS: Dict[str, asyncio.Task] = {}
 
-# 存储已下载视频信息的文件
-VIDEOS_INFO_FILE = BASE_DIR / "videos_info.json"
+# 通过WebSocket订阅下载进度的队列（按视频ID）
+PROGRESS_QUEUES: Dict[str, List[asyncio.Queue]] = {}
+# 主事件循环，供yt-dlp线程推送进度
+MAIN_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+# yt-dlp下载专用线程池，与FastAPI默认线程池隔离，避免大量下载占满默认线程池
+# 下载都在_DL_SEM内进行，线程数与同时下载数上限一致
+YTDLP_POOL: Optional[ThreadPoolExecutor] = None
+# 只获取视频信息的线程池，与下载分开，长时间的下载不会阻塞获取格式
+INFO_WORKERS = int(os.environ.get('INFO_WORKERS', '4'))
+INFO_POOL: Optional[ThreadPoolExecutor] = None
+
+# 视频信息缓存（按视频ID索引，10分钟过期），获取格式后再下载时无需重复解析
+INFO_CACHE = TTLCache(maxsize=2048, ttl=600)
+FORMATS_CACHE = TTLCache(maxsize=2048, ttl=600)
+
+# 流式下载时每次读取的数据块大小
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 获取视频信息的配置（网络相关设置与下载一致）
+INFO_YDL_OPTS = {
+    'skip_download': True,
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,  # 链接带有list参数时只处理当前视频
+    'socket_timeout': 60,  # 延长超时时间到60秒
+    'retries': 10,  # 增加重试次数到10次
+    'retry_sleep': lambda n: 5 * (n + 1),  # 重试间隔递增
+    'source_address': '0.0.0.0',  # 允许所有网络接口
+}
+_info_proxy = os.environ.get('HTTP_PROXY') or os.environ.get('HTTPS_PROXY')
+if _info_proxy:
+    INFO_YDL_OPTS.update({
+        'proxy': _info_proxy,
+        'socket_timeout': 120,
+    })
+
+# 存储已下载视频信息的文件（JSON Lines，每行一条记录，同ID以最后一条为准）
+VIDEOS_INFO_FILE = BASE_DIR / "videos_info.jsonl"
+# 旧版JSON数组格式的文件，首次启动时自动迁移
+LEGACY_VIDEOS_INFO_FILE = BASE_DIR / "videos_info.json"
 
 # 视频信息模型
 class VideoInfo(BaseModel):
@@ -52,97 +153,317 @@ class VideoInfo(BaseModel):
     thumbnail: str
     download_date: str
 
+# 内存中的视频信息索引（按ID），启动时从文件加载一次
+VIDEOS_INDEX: Dict[str, VideoInfo] = {}
+# 信息文件当前的行数，用于判断是否需要压缩
+_videos_log_lines = 0
+# 视频列表快照，索引变化时才重新生成
+_videos_list: Optional[List[VideoInfo]] = None
+
+# 读写信息文件使用的缓冲区大小
+VIDEOS_IO_BUFFER = 64 * 1024
+# 检查是否需要压缩信息文件的间隔（秒）
+COMPACT_INTERVAL = 300
+# 保存视频信息后延迟写入的时间（秒），期间的多条记录合并为一次写入
+FLUSH_DELAY = 0.5
+
+# 等待写入信息文件的记录
+_pending_lines: List[bytes] = []
+_videos_dirty: Optional[asyncio.Event] = None
+# 防止写入与压缩交错
+_videos_lock: Optional[asyncio.Lock] = None
+
+def _index_video(video: VideoInfo):
+    global _videos_list
+    
+    # 同ID的旧记录移到末尾，保持最新下载的视频排在最后
+    VIDEOS_INDEX.pop(video.id, None)
+    VIDEOS_INDEX[video.id] = video
+    _videos_list = None
+
+# 启动时加载已下载视频信息
+def _load_videos_index():
+    global _videos_log_lines
+    
+    if VIDEOS_INFO_FILE.exists():
+        with open(VIDEOS_INFO_FILE, "rb", buffering=VIDEOS_IO_BUFFER) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                _videos_log_lines += 1
+                try:
+                    _index_video(VideoInfo(**orjson.loads(line)))
+                except Exception as e:
+                    print(f"Error loading video info: {e}")
+    
+    elif LEGACY_VIDEOS_INFO_FILE.exists():
+        # 从旧版JSON数组文件迁移
+        try:
+            with open(LEGACY_VIDEOS_INFO_FILE, "rb") as f:
+                for item in orjson.loads(f.read()):
+                    _index_video(VideoInfo(**item))
+            _compact_videos_log(load_videos_info())
+        except Exception as e:
+            print(f"Error loading videos info: {e}")
+
+# 序列化一条视频信息记录（含换行符）
+def _dump_video_line(video: VideoInfo) -> bytes:
+    return orjson.dumps(video.model_dump(), option=orjson.OPT_APPEND_NEWLINE)
+
+# 用给定的记录重写信息文件，去掉被覆盖的旧记录
+def _compact_videos_log(videos: List[VideoInfo]):
+    global _videos_log_lines
+    
+    tmp_file = VIDEOS_INFO_FILE.with_suffix(".jsonl.tmp")
+    with open(tmp_file, "wb", buffering=VIDEOS_IO_BUFFER) as f:
+        for video in videos:
+            f.write(_dump_video_line(video))
+    os.replace(tmp_file, VIDEOS_INFO_FILE)
+    _videos_log_lines = len(videos)
+
+# 定期压缩信息文件
+async def _compact_videos_log_periodically():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        if _videos_log_lines > 2 * len(VIDEOS_INDEX):
+            async with _videos_lock:
+                try:
+                    # 在线程中写文件，避免阻塞事件循环
+                    pending = len(_pending_lines)
+                    await asyncio.to_thread(_compact_videos_log, load_videos_info())
+                    # 未写入的记录已包含在重写的文件中
+                    del _pending_lines[:pending]
+                except Exception as e:
+                    print(f"Error compacting videos info: {e}")
+
+# 把等待中的记录一次性追加到信息文件
+async def _flush_videos_log():
+    global _videos_log_lines
+    
+    async with _videos_lock:
+        if not _pending_lines:
+            return
+        lines = _pending_lines[:]
+        del _pending_lines[:len(lines)]
+        try:
+            async with aiofiles.open(VIDEOS_INFO_FILE, "ab") as f:
+                await f.write(b"".join(lines))
+        except Exception:
+            # 写入失败时放回，下次再试
+            _pending_lines[:0] = lines
+            _videos_dirty.set()
+            raise
+        _videos_log_lines += len(lines)
+
+# 有新记录时延迟一段时间后写入信息文件
+async def _flush_videos_log_periodically():
+    while True:
+        await _videos_dirty.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        _videos_dirty.clear()
+        try:
+            await _flush_videos_log()
+        except Exception as e:
+            print(f"Error saving videos info: {e}")
+
 # 加载已下载视频信息
 def load_videos_info() -> List[VideoInfo]:
-    if not VIDEOS_INFO_FILE.exists():
-        return []
-    try:
-        with open(VIDEOS_INFO_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return [VideoInfo(**item) for item in data]
-    except Exception as e:
-        print(f"Error loading videos info: {e}")
-        return []
+    global _videos_list
+    
+    if _videos_list is None:
+        _videos_list = list(VIDEOS_INDEX.values())
+    return _videos_list
 
-# 保存视频信息
+_load_videos_index()
+
+# 保存视频信息（由后台任务追加到信息文件末尾）
 async def save_video_info(video_info: VideoInfo):
-    videos = load_videos_info()
-    # 检查是否已存在相同ID的视频
-    videos = [v for v in videos if v.id != video_info.id]
-    videos.append(video_info)
-    
-    async with aiofiles.open(VIDEOS_INFO_FILE, "w", encoding="utf-8") as f:
-        await f.write(json.dumps([v.model_dump() for v in videos], ensure_ascii=False, indent=2))
+    _index_video(video_info)
+    _pending_lines.append(_dump_video_line(video_info))
+    _videos_dirty.set()
+
+# 把进度放入订阅队列（在事件循环中执行）
+def _put_progress(video_id: str, payload: Dict[str, Any]):
+    for queue in PROGRESS_QUEUES.get(video_id, ()):
+        queue.put_nowait(payload)
+
+# 推送进度给订阅者，可在yt-dlp线程中调用
+def _publish_progress(video_id: str, payload: Dict[str, Any]):
+    if MAIN_LOOP is None or video_id not in PROGRESS_QUEUES:
+        return
+    MAIN_LOOP.call_soon_threadsafe(_put_progress, video_id, payload)
+
+# 更新下载进度（在原记录上修改），reset为True时先清空旧记录
+def _set_progress(video_id: str, reset: bool = False, **fields):
+    with _progress_lock:
+        if reset:
+            download_progress.pop(video_id, None)
+        progress = download_progress.setdefault(video_id, {})
+        progress.update(fields)
+        download_progress.move_to_end(video_id)
+        if len(download_progress) > MAX_PROGRESS_ENTRIES:
+            download_progress.popitem(last=False)
+        payload = dict(progress)
+    _publish_progress(video_id, payload)
+
+# 获取下载进度的副本，不存在时返回None
+def _get_progress(video_id: str) -> Optional[Dict[str, Any]]:
+    with _progress_lock:
+        progress = download_progress.get(video_id)
+        return dict(progress) if progress is not None else None
 
 # 自定义进度钩子
 def progress_hook(d):
     video_id = d.get('info_dict', {}).get('id', 'unknown')
     
     if d['status'] == 'downloading':
+        now = time.monotonic()
+        if now - _LAST_EMIT.get(video_id, 0.0) < PROGRESS_INTERVAL:
+            return
+        _LAST_EMIT[video_id] = now
+        
         downloaded = d.get('downloaded_bytes', 0)
         total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
         
         if total > 0:
             progress = (downloaded / total) * 100
-            download_progress[video_id] = {
-                'progress': round(progress, 2),
-                'speed': d.get('speed', 0),
-                'eta': d.get('eta', 0),
-                'status': 'downloading'
-            }
+            _set_progress(
+                video_id,
+                progress=round(progress, 2),
+                speed=d.get('speed', 0),
+                eta=d.get('eta', 0),
+                status='downloading'
+            )
     
     elif d['status'] == 'finished':
-        download_progress[video_id] = {
-            'progress': 100,
-            'status': 'finished'
-        }
+        _LAST_EMIT.pop(video_id, None)
+        _set_progress(video_id, progress=100, status='finished', final_size=d.get('total_bytes'))
 
-# 获取视频可用格式
-async def get_video_formats(url: str):
-    ydl_opts = {
-        'skip_download': True,
-        'quiet': True,
-        'no_warnings': True,
-    }
+# 匹配YouTube视频链接并提取11位视频ID
+_YT_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:.*[?&]v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+
+# 从URL中提取视频ID，不是有效的YouTube视频链接时返回None
+def extract_video_id(url: str) -> Optional[str]:
+    m = _YT_ID_RE.search(url)
+    return m.group(1) if m else None
+
+# 从分辨率字符串（如 "1920x1080"、"1080p"）中解析高度，无法解析时返回0
+def _parse_res(resolution: str) -> int:
+    if 'x' in resolution:
+        resolution = resolution.split('x')[1]
+    try:
+        return int(resolution.rstrip('p'))
+    except ValueError:
+        return 0
+
+# 缓存的视频信息只保留用到的字段，yt-dlp返回的完整信息（分片、字幕等）可能很大
+_INFO_KEYS = ('id', 'title', 'ext', 'duration', 'uploader', 'description', 'thumbnail')
+_FORMAT_KEYS = ('format_id', 'resolution', 'ext', 'fps', 'filesize', 'format_note', 'vcodec', 'acodec', 'height')
+
+def _trim_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    trimmed = {k: info[k] for k in _INFO_KEYS if k in info}
+    trimmed['formats'] = [
+        {k: f[k] for k in _FORMAT_KEYS if k in f}
+        for f in info.get('formats') or []
+    ]
+    return trimmed
+
+# 每个获取信息的线程复用一个YoutubeDL实例（YoutubeDL不是线程安全的）
+_info_ydl_local = threading.local()
+
+def _extract_info(url: str) -> Dict[str, Any]:
+    ydl = getattr(_info_ydl_local, 'ydl', None)
+    if ydl is None:
+        ydl = _info_ydl_local.ydl = yt_dlp.YoutubeDL(INFO_YDL_OPTS)
+    return ydl.extract_info(url, download=False)
+
+# 获取视频信息（优先使用缓存）
+async def _get_info(url: str) -> Dict[str, Any]:
+    video_id = extract_video_id(url)
+    info = INFO_CACHE.get(video_id) if video_id else None
+    if info is not None:
+        return info
     
     loop = asyncio.get_event_loop()
+    info = _trim_info(await loop.run_in_executor(INFO_POOL, _extract_info, url))
     
+    INFO_CACHE[info.get('id') or video_id] = info
+    return info
+
+# 返回给前端的格式数量上限（按分辨率从高到低）
+MAX_FORMATS = 12
+
+# 提取单个格式中前端需要的信息
+def _to_info(f: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'format_id': f.get('format_id'),
+        'resolution': f.get('resolution', 'unknown'),
+        'ext': f.get('ext', 'mp4'),
+        'fps': f.get('fps', 0),
+        'filesize': f.get('filesize', 0),
+        'format_note': f.get('format_note', ''),
+        'vcodec': f.get('vcodec', ''),
+        'height': f.get('height') or _parse_res(f.get('resolution') or ''),
+    }
+
+# 获取视频可用格式
+async def get_video_formats(url: str):
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
-            
-            # 提取视频格式信息
-            formats = []
-            for f in info.get('formats', []):
-                # 只选择有视频流的格式
-                if f.get('vcodec') != 'none' and f.get('resolution') != 'audio only':
-                    format_info = {
-                        'format_id': f.get('format_id'),
-                        'resolution': f.get('resolution', 'unknown'),
-                        'ext': f.get('ext', 'mp4'),
-                        'fps': f.get('fps', 0),
-                        'filesize': f.get('filesize', 0),
-                        'format_note': f.get('format_note', ''),
-                        'vcodec': f.get('vcodec', ''),
-                    }
-                    formats.append(format_info)
-            
-            # 按分辨率排序（从高到低）
-            formats.sort(key=lambda x: (
-                0 if x['resolution'] == 'unknown' else 
-                int(x['resolution'].split('x')[1]) if 'x' in x['resolution'] else 
-                int(x['resolution'].rstrip('p'))
-            ), reverse=True)
-            
-            return {
-                'id': info.get('id', 'unknown'),
-                'title': info.get('title', 'Unknown'),
-                'formats': formats
-            }
+        info = await _get_info(url)
+        video_id = info.get('id', 'unknown')
+        
+        cached = FORMATS_CACHE.get(video_id)
+        if cached is not None:
+            return cached
+        
+        # 提取视频格式信息，只选择有视频流的格式
+        candidates = (
+            _to_info(f) for f in info.get('formats', [])
+            if f.get('vcodec') != 'none' and f.get('resolution') != 'audio only'
+        )
+        
+        # 取分辨率最高的几个格式（从高到低）
+        formats = heapq.nlargest(MAX_FORMATS, candidates, key=operator.itemgetter('height'))
+        
+        result = {
+            'id': video_id,
+            'title': info.get('title', 'Unknown'),
+            'formats': formats
+        }
+        FORMATS_CACHE[video_id] = result
+        return result
     except Exception as e:
         print(f"Error getting video formats: {e}")
         return {'error': str(e)}
 
+# 常见下载错误与友好提示的对照表，按顺序匹配第一个命中的规则
+_ERR_MAP = (
+    (re.compile(r'HTTP Error 429'), "YouTube 限制了请求速率，请稍后再试。"),
+    (re.compile(r'HTTP Error 403'), "无法访问此视频，可能是地区限制或需要登录。"),
+    (re.compile(r'HTTP Error 404'), "视频不存在或已被删除。"),
+    (re.compile(r'Unable to download API page|WinError 10060|(?i:timed out)'),
+     "网络连接超时，建议：\n1. 检查网络连接\n2. 尝试使用代理服务器\n3. 稍后重试"),
+    (re.compile(r'This video is unavailable'), "此视频不可用，可能已被设为私有或删除。"),
+    (re.compile(r'Video unavailable'), "视频不可用，可能已被上传者删除或设为私有。"),
+    (re.compile(r'Sign in'), "此视频需要登录才能观看。"),
+    (re.compile(r'The uploader has not made this video available'), "上传者未在您的国家/地区提供此视频。"),
+    (re.compile(r'socket|network', re.IGNORECASE),
+     "网络连接不稳定，建议：\n1. 检查网络连接\n2. 尝试使用代理服务器\n3. 稍后重试"),
+    (re.compile(r'DNS'), "DNS解析失败，建议：\n1. 检查网络DNS设置\n2. 尝试使用其他DNS服务器\n3. 使用代理服务器"),
+)
+
+# 把yt-dlp的错误信息转换为友好的提示，没有匹配的规则时原样返回
+def _friendly_error(error_message: str) -> str:
+    for pattern, message in _ERR_MAP:
+        if pattern.search(error_message):
+            return message
+    return error_message
+
+# 删除描述中除制表符、换行符外的控制字符
+_CTRL_TRANS = str.maketrans('', '', ''.join(chr(c) for c in range(32) if c not in (9, 10, 13)))
+
 # 异步下载视频
 async def download_video(url: str, format_id: str = None):
     # 基本下载配置
@@ -150,6 +471,7 @@ async def download_video(url: str, format_id: str = None):
         'format': format_id if format_id else 'best',
         'outtmpl': str(DOWNLOAD_DIR / '%(title)s-%(id)s.%(ext)s'),
         'progress_hooks': [progress_hook],
+        'noplaylist': True,  # 链接带有list参数时只下载当前视频
         'quiet': False,
         'no_warnings': False,
         'socket_timeout': 60,  # 延长超时时间到60秒
@@ -169,78 +491,70 @@ async def download_video(url: str, format_id: str = None):
     
     loop = asyncio.get_event_loop()
     
-    # 先获取视频信息
-    info_opts = dict(ydl_opts)
-    info_opts['skip_download'] = True
-    
     try:
-        with yt_dlp.YoutubeDL(info_opts) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
+        async with _DL_SEM:
+            # 先获取视频信息（获取格式时已缓存则直接复用）
+            info = await _get_info(url)
             video_id = info.get('id', 'unknown')
             
             # 设置初始进度
-            download_progress[video_id] = {
-                'progress': 0,
-                'status': 'starting'
-            }
+            _set_progress(video_id, progress=0, status='starting')
             
             # 下载视频
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=True))
-            
-            # 获取下载后的文件信息
-            filename = f"{info['title']}-{info['id']}.{info['ext']}"
-            file_path = DOWNLOAD_DIR / filename
-            file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-            
-            # 保存视频信息
-            video_info = VideoInfo(
-                id=info['id'],
-                title=info['title'],
-                duration=info.get('duration', 0),
-                author=info.get('uploader', 'Unknown'),
-                description=info.get('description', '')[:500],  # 限制描述长度
-                file_size=f"{file_size:.2f} MB",
-                file_path=f"/downloads/{filename}",
-                thumbnail=info.get('thumbnail', ''),
-                download_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
-            
-            await save_video_info(video_info)
-            return video_info
-            
+                downloaded = await loop.run_in_executor(YTDLP_POOL, lambda: ydl.extract_info(url, download=True))
+        
+        # 标题与缓存不一致说明缓存已过时，以实际下载结果为准，并使缓存失效
+        # （缓存的信息没有指定格式，扩展名与实际下载的格式无关，不参与比较）
+        if downloaded and downloaded.get('title') != info.get('title'):
+            INFO_CACHE.pop(video_id, None)
+            FORMATS_CACHE.pop(video_id, None)
+            info = downloaded
+        
+        # 获取下载后的文件信息，使用yt-dlp实际保存的路径（标题中的特殊字符会被替换）
+        requested = (downloaded or {}).get('requested_downloads') or [{}]
+        file_path = Path(
+            requested[0].get('filepath')
+            or DOWNLOAD_DIR / f"{info['title']}-{info['id']}.{(downloaded or info)['ext']}"
+        )
+        filename = file_path.name
+        # 优先使用进度钩子记录的文件大小；合并了多个格式时以磁盘上的实际文件为准
+        size_bytes = (_get_progress(video_id) or {}).get('final_size')
+        if not size_bytes or (downloaded or {}).get('requested_formats'):
+            size_bytes = (await aiofiles.os.stat(file_path)).st_size
+        file_size = size_bytes / (1024 * 1024)  # MB
+        
+        # 保存视频信息
+        video_info = VideoInfo(
+            id=info['id'],
+            title=info['title'],
+            duration=info.get('duration', 0),
+            author=info.get('uploader', 'Unknown'),
+            description=(info.get('description') or '')[:500].translate(_CTRL_TRANS),  # 限制描述长度
+            file_size=f"{file_size:.2f} MB",
+            file_path=f"/downloads/{filename}",
+            thumbnail=info.get('thumbnail', ''),
+            download_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+        
+        await save_video_info(video_info)
+        return video_info
+        
     except Exception as e:
-        video_id = url.split("v=")[-1].split("&")[0] if "v=" in url else "unknown"
+        video_id = extract_video_id(url) or "unknown"
         error_message = str(e)
         
         # 提供更友好的错误消息
-        if "HTTP Error 429" in error_message:
-            error_message = "YouTube 限制了请求速率，请稍后再试。"
-        elif "HTTP Error 403" in error_message:
-            error_message = "无法访问此视频，可能是地区限制或需要登录。"
-        elif "HTTP Error 404" in error_message:
-            error_message = "视频不存在或已被删除。"
-        elif "Unable to download API page" in error_message or "timed out" in error_message.lower() or "WinError 10060" in error_message:
-            error_message = "网络连接超时，建议：\n1. 检查网络连接\n2. 尝试使用代理服务器\n3. 稍后重试"
-        elif "This video is unavailable" in error_message:
-            error_message = "此视频不可用，可能已被设为私有或删除。"
-        elif "Video unavailable" in error_message:
-            error_message = "视频不可用，可能已被上传者删除或设为私有。"
-        elif "Sign in" in error_message:
-            error_message = "此视频需要登录才能观看。"
-        elif "The uploader has not made this video available" in error_message:
-            error_message = "上传者未在您的国家/地区提供此视频。"
-        elif "socket" in error_message.lower() or "network" in error_message.lower():
-            error_message = "网络连接不稳定，建议：\n1. 检查网络连接\n2. 尝试使用代理服务器\n3. 稍后重试"
-        elif "DNS" in error_message:
-            error_message = "DNS解析失败，建议：\n1. 检查网络DNS设置\n2. 尝试使用其他DNS服务器\n3. 使用代理服务器"
+        error_message = _friendly_error(error_message)
         
-        download_progress[video_id] = {
-            'progress': 0,
-            'status': 'error',
-            'error': error_message,
-            'original_error': str(e)  # 保存原始错误信息以便调试
-        }
+        _LAST_EMIT.pop(video_id, None)
+        _set_progress(
+            video_id,
+            progress=0,
+            status='error',
+            error=error_message,
+            original_error=str(e)  # 保存原始错误信息以便调试
+        )
         print(f"Error downloading video: {e}")
         return None
 
@@ -248,15 +562,15 @@ async def download_video(url: str, format_id: str = None):
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     videos = load_videos_info()
-    return templates.TemplateResponse(
-        "index.html", 
-        {"request": request, "videos": videos}
-    )
+    # 视频较多时渲染耗时较长，放到线程中执行，避免阻塞事件循环
+    template = templates.get_template("index.html")
+    html = await asyncio.to_thread(template.render, {"request": request, "videos": videos})
+    return HTMLResponse(html)
 
 @app.get("/video-formats/")
 async def get_formats(url: str = Query(...)):
     # 验证URL格式
-    if not url or not any(domain in url for domain in ['youtube.com', 'youtu.be']):
+    if not extract_video_id(url):
         return {"status": "error", "message": "请输入有效的YouTube视频链接"}
     
     # 获取视频格式
@@ -268,45 +582,193 @@ async def get_formats(url: str = Query(...)):
     return {"status": "success", "data": formats_info}
 
 @app.post("/download/")
-async def download(background_tasks: BackgroundTasks, url: str = Form(...), format_id: Optional[str] = Form(None)):
-    # 验证URL格式
-    if not url or not any(domain in url for domain in ['youtube.com', 'youtu.be']):
+async def download(url: str = Form(...), format_id: Optional[str] = Form(None)):
+    # 验证URL格式并提取视频ID
+    video_id = extract_video_id(url)
+    if not video_id:
         return {"status": "error", "message": "请输入有效的YouTube视频链接"}
     
-    # 从URL中提取视频ID
-    if "youtube.com" in url and "v=" in url:
-        video_id = url.split("v=")[-1].split("&")[0]
-    elif "youtu.be" in url:
-        video_id = url.split("/")[-1].split("?")[0]
-    else:
-        video_id = "unknown"
-        
-    if video_id == "unknown":
-        return {"status": "error", "message": "无法识别视频ID，请检查链接格式"}
+    # 同一视频已在下载时直接返回，不重复下载
+    task = ACTIVE_DOWNLOADS.get(video_id)
+    if task is not None and not task.done():
+        return {"status": "success", "message": "Download already in progress", "video_id": video_id}
     
     # 设置初始进度
-    download_progress[video_id] = {
-        'progress': 0,
-        'status': 'queued'
-    }
+    _set_progress(video_id, reset=True, progress=0, status='queued')
     
     # 在后台任务中下载视频
-    background_tasks.add_task(download_video, url, format_id)
+    task = asyncio.create_task(download_video(url, format_id))
+    ACTIVE_DOWNLOADS[video_id] = task
+    
+    def _forget(t: asyncio.Task):
+        if ACTIVE_DOWNLOADS.get(video_id) is t:
+            del ACTIVE_DOWNLOADS[video_id]
+    task.add_done_callback(_forget)
     
     return {"status": "success", "message": "Download started", "video_id": video_id}
 
+@app.get("/stream/")
+async def stream(url: str = Query(...), format_id: Optional[str] = Query(None)):
+    # 验证URL格式并提取视频ID
+    video_id = extract_video_id(url)
+    if not video_id:
+        return {"status": "error", "message": "请输入有效的YouTube视频链接"}
+    
+    # 只使用提取出的视频ID重新拼接链接，不把用户输入直接作为yt-dlp命令行参数
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    try:
+        info = await _get_info(url)
+    except Exception as e:
+        print(f"Error getting video info: {e}")
+        return {"status": "error", "message": str(e)}
+    
+    # 输出到管道时无法合并音视频，只能使用同时包含音视频的单一格式
+    progressive = [
+        f for f in info.get('formats', [])
+        if f.get('vcodec') != 'none' and f.get('acodec') != 'none'
+    ]
+    if format_id:
+        fmt = next((f for f in progressive if f.get('format_id') == format_id), None)
+    else:
+        # yt-dlp的格式列表按质量从低到高排列，未指定时使用最后一个
+        fmt = progressive[-1] if progressive else None
+    if fmt is None:
+        return ORJSONResponse(
+            {"status": "error", "message": "该格式不可用或不同时包含音视频，无法直接下载"},
+            status_code=400
+        )
+    ext = fmt.get('ext') or 'mp4'
+    filename = f"{info.get('title', video_id)}-{video_id}.{ext}"
+    
+    # yt-dlp直接输出到标准输出，边下载边发送给用户，不在服务器上保存文件
+    cmd = [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-playlist', '-f', fmt['format_id'], '-o', '-']
+    if INFO_YDL_OPTS.get('proxy'):
+        cmd += ['--proxy', INFO_YDL_OPTS['proxy']]
+    cmd += ['--', url]
+    
+    # 流式下载同样占用一个下载名额，直到yt-dlp进程结束
+    await _DL_SEM.acquire()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+    except BaseException:
+        _DL_SEM.release()
+        raise
+    
+    stopped = False
+    
+    async def stop():
+        nonlocal stopped
+        if stopped:
+            return
+        stopped = True
+        try:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+        finally:
+            _DL_SEM.release()
+    
+    # 先读取第一个数据块，yt-dlp启动失败时返回错误而不是空文件
+    try:
+        first_chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        if not first_chunk:
+            await proc.wait()
+    except BaseException:
+        await stop()
+        raise
+    if not first_chunk and proc.returncode != 0:
+        await stop()
+        return ORJSONResponse(
+            {"status": "error", "message": "获取视频流失败，请稍后重试"},
+            status_code=502
+        )
+    
+    async def body():
+        try:
+            chunk = first_chunk
+            while chunk:
+                yield chunk
+                chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        finally:
+            # 用户中途断开时结束yt-dlp进程
+            await stop()
+    
+    return StreamingResponse(
+        body(),
+        media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+    )
+
+@app.api_route("/downloads/{path}", methods=["GET", "HEAD"], name="downloads")
+async def serve_download(path: str):
+    # 只允许访问下载目录下的文件，防止目录遍历
+    if not path or Path(path).name != path:
+        raise HTTPException(status_code=404)
+    
+    file_path = DOWNLOAD_DIR / path
+    if not await aiofiles.os.path.isfile(file_path):
+        raise HTTPException(status_code=404)
+    
+    if DOWNLOADS_ACCEL_PREFIX:
+        return Response(headers={'X-Accel-Redirect': DOWNLOADS_ACCEL_PREFIX.rstrip('/') + '/' + quote(path)})
+    # FileResponse支持Range请求，服务器支持时使用零拷贝发送
+    return FileResponse(file_path)
+
 @app.get("/progress/{video_id}")
 async def get_progress(video_id: str):
-    if video_id in download_progress:
-        return download_progress[video_id]
-    return {"status": "not_found"}
+    return _get_progress(video_id) or {"status": "not_found"}
+
+@app.websocket("/ws/progress/{video_id}")
+async def progress_ws(websocket: WebSocket, video_id: str):
+    await websocket.accept()
+    
+    queue = asyncio.Queue()
+    PROGRESS_QUEUES.setdefault(video_id, []).append(queue)
+    try:
+        # 先发送当前进度，之后每次更新推送一次，直到下载结束
+        progress = _get_progress(video_id) or {"status": "not_found"}
+        while True:
+            await websocket.send_text(orjson.dumps(progress).decode())
+            if progress.get('status') in ('finished', 'error', 'not_found'):
+                break
+            progress = await queue.get()
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        queues = PROGRESS_QUEUES.get(video_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            PROGRESS_QUEUES.pop(video_id, None)
 
 @app.get("/videos/")
 async def get_videos():
     videos = load_videos_info()
     return videos
 
+@app.post("/cache/clear")
+async def clear_cache():
+    cleared = len(INFO_CACHE)
+    INFO_CACHE.clear()
+    FORMATS_CACHE.clear()
+    return {"status": "success", "cleared": cleared}
+
 # 本地开发时使用，部署时会被忽略
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000)
\ No newline at end of file
+    # 安装了uvloop和httptools（uvicorn[standard]）时，auto会自动使用它们
+    # 下载进度、视频信息索引等状态保存在进程内存中，多个进程之间不共享，
+    # 在改为共享存储之前WORKERS应保持为1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get('WORKERS', '1')),
+        loop="auto",
+        http="auto",
+        access_log=False,
+    )